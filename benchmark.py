@@ -8,8 +8,17 @@ __author__ = """Loïc Séguin-C. <loicseguin@gmail.com>"""
 # All rights reserved.
 # BSD license.
 
+import argparse
+import functools
+import json
+import platform
+import random
+import sys
+import time
+
 import networkx as nx
-import matplotlib.pyplot as plt
+
+import confluent
 
 
 def digraph1():
@@ -101,9 +110,391 @@ def pyramid(N):
     return G, pos
 
 
-def draw_pyramid_flow(G, pos, sinks):
+def random_dag(n, p=0.25, nb_sinks=10, max_demand=3, max_capacity=6,
+               window=15, seed=None):
+    """Generate a random acyclic instance of the confluent flow problem with
+    integer demands and capacities.
+
+    Nodes are the integers 0 to n - 1 and arcs only go from a node to one of
+    the `window` nodes that follow it.  The last `nb_sinks` nodes are the only
+    ones with an arc to the sink 't'.  Every other node has a random demand
+    between 0 and `max_demand`, an arc of capacity equal to the total demand
+    to a random node after it, so that all demands can reach 't', and arcs to
+    the next nodes with probability `p` and random capacities between 1 and
+    `max_capacity`.
+
+    Examples
+    --------
+    >>> import benchmark
+    >>> G = benchmark.random_dag(100, seed=42)
+    >>> nx.is_directed_acyclic_graph(G)
+    True
+
+    """
+    rng = random.Random(seed)
+    G = nx.DiGraph()
+    first_sink = n - nb_sinks
+    for i in range(first_sink):
+        G.add_node(i, demand=rng.randint(0, max_demand))
+    total_demand = sum(d['demand'] for _, d in G.nodes_iter(data=True))
+    for i in range(first_sink):
+        for j in range(i + 1, min(n, i + window)):
+            if rng.random() < p:
+                G.add_edge(i, j, capacity=rng.randint(1, max_capacity))
+        G.add_edge(i, rng.randint(i + 1, n - 1), capacity=total_demand)
+    for i in range(first_sink, n):
+        G.add_node(i, demand=0)
+        G.add_edge(i, 't', capacity=total_demand)
+    return G
+
+
+def grid(rows, cols=None, max_demand=3, max_capacity=6, seed=None):
+    """Generate a grid instance of the confluent flow problem with integer
+    demands and capacities.
+
+    Nodes are the pairs (i, j) with 0 <= i < rows and 0 <= j < cols.  Every
+    node has arcs to its left, right and lower neighbors with random
+    capacities between 1 and `max_capacity` and a random demand between 0 and
+    `max_demand`.  The nodes of the last row have an arc without capacity to
+    the sink 't'.  Not all demands can always reach 't'.
+
+    Examples
+    --------
+    >>> import benchmark
+    >>> G = benchmark.grid(3, 4, seed=42)
+    >>> len(G), G.number_of_edges()
+    (13, 30)
+
+    """
+    if cols is None:
+        cols = rows
+    rng = random.Random(seed)
+    G = nx.DiGraph()
+    for i in range(rows):
+        for j in range(cols):
+            G.add_node((i, j), demand=rng.randint(0, max_demand))
+            for u, v in (((i, j), (i, j + 1)), ((i, j + 1), (i, j)),
+                         ((i, j), (i + 1, j))):
+                if u[0] < rows and v[0] < rows and u[1] < cols and v[1] < cols:
+                    G.add_edge(u, v, capacity=rng.randint(1, max_capacity))
+    for j in range(cols):
+        G.add_edge((rows - 1, j), 't')
+    return G
+
+
+def random_sparse(n, degree=3, nb_sinks=10, max_demand=3, max_capacity=6,
+                  seed=None):
+    """Generate a random sparse instance of the confluent flow problem with
+    integer demands and capacities.
+
+    The graph is a random directed graph with n nodes and ``degree * n`` arcs
+    with random capacities between 1 and `max_capacity`, so it usually has
+    cycles.  Every node has a random demand between 0 and `max_demand` and the
+    nodes 0 to `nb_sinks` - 1 have an arc without capacity to the sink 't'.
+    Not all demands can always reach 't'.
+
+    Examples
+    --------
+    >>> import benchmark
+    >>> G = benchmark.random_sparse(100, seed=42)
+    >>> len(G), G.number_of_edges()
+    (101, 310)
+
+    """
+    rng = random.Random(seed)
+    G = nx.gnm_random_graph(n, degree * n, seed=rng.randint(0, 2**31),
+                            directed=True)
+    for u, v, d in G.edges_iter(data=True):
+        d['capacity'] = rng.randint(1, max_capacity)
+    for v in range(n):
+        G.node[v]['demand'] = rng.randint(0, max_demand)
+    for v in range(nb_sinks):
+        G.add_edge(v, 't')
+    return G
+
+
+def _import_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError('The array generators require NumPy '
+                          '(http://www.numpy.org/)')
+    return np
+
+
+def pyramid_arrays(N):
+    """Generate the pyramid graph of `pyramid` with N layers as arrays.
+
+    Node (i, j) of `pyramid` is node ``i * (i + 1) // 2 + j`` and the sink
+    is node ``N * (N + 1) // 2``.  See `to_networkx` for the arrays.
+
+    Examples
+    --------
+    >>> import benchmark
+    >>> tails, heads, capacity, demand, t = benchmark.pyramid_arrays(4)
+    >>> t, len(tails)
+    (10, 16)
+    >>> G = benchmark.to_networkx(tails, heads, capacity, demand, t)
+    >>> G[3][6]
+    {'capacity': 0.75}
+
+    """
+    np = _import_numpy()
+    n = N * (N + 1) // 2
+    layer = np.repeat(np.arange(N), np.arange(1, N + 1))
+    first = layer * (layer + 1) // 2
+    node = np.arange(n)
+    pos = node - first
+    demand = np.append(1.0 / (layer + 1), 0.0)
+
+    inner = layer < N - 1
+    u = node[inner]
+    i = layer[inner]
+    j = pos[inner]
+    below = u + i + 1
+    right = (j + 1.0) / (i + 2)
+    tails = np.concatenate([np.repeat(u, 2), node[~inner]])
+    heads = np.concatenate([np.column_stack([below, below + 1]).ravel(),
+                            np.full(N, n)])
+    capacity = np.concatenate([np.column_stack([1.0 - right, right]).ravel(),
+                               np.full(N, np.inf)])
+    return tails, heads, capacity, demand, n
+
+
+def layered_dag_arrays(layers, width, fanout=3, max_demand=3,
+                       max_capacity=6, seed=None):
+    """Generate a layered random DAG instance of the confluent flow problem
+    as arrays.
+
+    Layer l has the nodes ``l * width`` to ``(l + 1) * width - 1``.  Every
+    node has a random demand between 0 and `max_demand` and `fanout`
+    consecutive (modulo `width`) nodes of the next layer, starting at a
+    random one, as successors with random capacities between 1 and
+    `max_capacity`.  The nodes of the last layer have an arc to the sink,
+    node ``layers * width``, with capacity equal to the total demand.  Not
+    all demands can always reach the sink.  See `to_networkx` for the arrays.
+
+    Examples
+    --------
+    >>> import benchmark
+    >>> arrays = benchmark.layered_dag_arrays(4, 10, seed=42)
+    >>> G = benchmark.to_networkx(*arrays)
+    >>> len(G), G.number_of_edges(), nx.is_directed_acyclic_graph(G)
+    (41, 100, True)
+
+    """
+    np = _import_numpy()
+    rng = np.random.RandomState(seed)
+    n = layers * width
+    demand = np.append(rng.randint(0, max_demand + 1, n), 0)
+    inner = np.arange(n - width)
+    start = rng.randint(0, width, len(inner))
+    offset = (start[:, None] + np.arange(fanout)) % width
+    heads = ((inner // width + 1) * width)[:, None] + offset
+    last = np.arange(n - width, n)
+    tails = np.concatenate([np.repeat(inner, fanout), last])
+    heads = np.concatenate([heads.ravel(), np.full(width, n)])
+    capacity = np.concatenate([
+        rng.randint(1, max_capacity + 1, len(inner) * fanout),
+        np.full(width, demand.sum())])
+    return tails, heads, capacity, demand, n
+
+
+def grid_arrays(rows, cols=None, max_demand=3, max_capacity=6, seed=None):
+    """Generate the grid instance of `grid` as arrays, with other random
+    demands and capacities.
+
+    Node (i, j) of `grid` is node ``i * cols + j`` and the sink is node
+    ``rows * cols``.  The arcs of the last row to the sink have capacity
+    equal to the total demand.  See `to_networkx` for the arrays.
+
+    Examples
+    --------
+    >>> import benchmark
+    >>> G = benchmark.to_networkx(*benchmark.grid_arrays(3, 4, seed=42))
+    >>> len(G), G.number_of_edges()
+    (13, 30)
+
+    """
+    np = _import_numpy()
+    if cols is None:
+        cols = rows
+    rng = np.random.RandomState(seed)
+    n = rows * cols
+    demand = np.append(rng.randint(0, max_demand + 1, n), 0)
+    node = np.arange(n).reshape(rows, cols)
+    left = node[:, :-1].ravel()
+    up = node[:-1, :].ravel()
+    last = node[-1, :]
+    tails = np.concatenate([left, left + 1, up, last])
+    heads = np.concatenate([left + 1, left, up + cols, np.full(cols, n)])
+    capacity = np.concatenate([
+        rng.randint(1, max_capacity + 1, len(tails) - cols),
+        np.full(cols, demand.sum())])
+    return tails, heads, capacity, demand, n
+
+
+def to_networkx(tails, heads, capacity, demand, t, sink='t'):
+    """Build the NetworkX graph of an instance given as arrays.
+
+    Parameters
+    ----------
+    tails, heads : arrays
+        Arc a goes from node ``tails[a]`` to node ``heads[a]``.  Nodes are
+        the integers 0 to ``len(demand) - 1``.
+
+    capacity : array
+        Capacity of every arc.  Infinite capacities are left out of the
+        graph.
+
+    demand : array
+        Demand of every node.
+
+    t : integer
+        Sink node.
+
+    sink : node (optional, default = 't')
+        Label of the sink in the graph.
+
+    """
+    np = _import_numpy()
+    G = nx.DiGraph()
+    G.add_nodes_from(range(len(demand)))
+    for v, d in enumerate(demand.tolist()):
+        G.node[v]['demand'] = d
+    finite = np.isfinite(capacity)
+    G.add_weighted_edges_from(zip(tails[finite].tolist(),
+                                  heads[finite].tolist(),
+                                  capacity[finite].tolist()),
+                              weight='capacity')
+    G.add_edges_from(zip(tails[~finite].tolist(), heads[~finite].tolist()))
+    G.add_edges_from((u, sink, d) for u, d in G.pred[t].items())
+    G.add_edges_from((sink, v, d) for v, d in G.succ[t].items())
+    G.remove_node(t)
+    return G
+
+
+def flow_funcs():
+    """Return a dictionary of the maximum flow functions available to
+    `confluent.confluent_flow`, keyed by name.
+
+    """
+    funcs = {}
+    if hasattr(nx, 'ford_fulkerson'):
+        funcs['ford_fulkerson'] = nx.ford_fulkerson
+    try:
+        from scipy.sparse.csgraph import maximum_flow
+        funcs['csgraph'] = confluent.csgraph_maximum_flow
+    except ImportError:
+        pass
+    if hasattr(nx, 'maximum_flow'):
+        from networkx.algorithms import flow
+        for name in ('edmonds_karp', 'shortest_augmenting_path',
+                     'preflow_push', 'dinitz', 'boykov_kolmogorov'):
+            if hasattr(flow, name):
+                funcs[name] = functools.partial(
+                    nx.maximum_flow, flow_func=getattr(flow, name))
+    return funcs
+
+
+def compare_flow_funcs(instances=None, funcs=None, repeat=3):
+    """Time the computation of the support graph with every maximum flow
+    function and print a table of the best times in seconds.
+
+    Parameters
+    ----------
+    instances : list (optional)
+        List of (name, G, t) tuples.  By default, pyramids with 10, 20 and 40
+        layers and random DAGs with 200, 1000 and 5000 nodes.
+
+    funcs : dictionary (optional)
+        Maximum flow functions keyed by name.  By default, all the functions
+        returned by `flow_funcs`.
+
+    repeat : integer (optional, default = 3)
+        Number of times each computation is timed.
+
+    Returns
+    -------
+    times : dictionary
+        Keyed by (instance name, function name).  Values are the best time in
+        seconds or None if the function does not support the instance, e.g.,
+        `csgraph` on a pyramid, which has fractional capacities.
+
+    """
+    if instances is None:
+        instances = [('pyramid({})'.format(N), pyramid(N)[0], 't')
+                     for N in (10, 20, 40)]
+        instances += [('random_dag({})'.format(n), random_dag(n, seed=n), 't')
+                      for n in (200, 1000, 5000)]
+    if funcs is None:
+        funcs = flow_funcs()
+    names = sorted(funcs)
+
+    times = {}
+    print('{:20s}'.format('instance') +
+          ''.join('{:>26s}'.format(name) for name in names))
+    for instance_name, G, t in instances:
+        row = '{:20s}'.format(instance_name)
+        for name in names:
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                try:
+                    confluent._compute_support_for_max_flow(
+                        G, t, flow_func=funcs[name])
+                except nx.NetworkXError:
+                    break
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            times[instance_name, name] = best
+            row += '{:>26s}'.format('n/a' if best is None
+                                    else '{:.4f}'.format(best))
+        print(row)
+    return times
+
+
+def draw_pyramid_flow(G, pos, sinks, with_labels=True, node_size=600,
+                      ax=None, filename=None, dpi=100, rasterized=None):
     """Make a nice drawing of the confluent flow `sinks` on a pyramid graph G.
 
+    All the tree arcs are drawn in one collection colored by tree and the
+    nodes in one scatter plot, so that the drawing takes time linear in the
+    size of the graph whatever the number of trees.
+
+    Parameters
+    ----------
+    G : graph
+        Pyramid graph, as returned by `pyramid`.
+
+    pos : dictionary
+        Position of every node, as returned by `pyramid`.
+
+    sinks : dictionary or SinkTrees
+        Sink trees, as returned by `confluent.confluent_flow`.
+
+    with_labels : boolean (optional, default = True)
+        If True, write the demand of every node on it.  Labels are slow to
+        draw and unreadable on large pyramids.
+
+    node_size : float (optional, default = 600)
+        Size of the nodes, in points squared.
+
+    ax : matplotlib Axes (optional)
+        Axes to draw on.  By default, the current axes.
+
+    filename : string (optional)
+        If given, the figure is saved to this file, e.g., a PNG image.
+
+    dpi : integer (optional, default = 100)
+        Resolution of the saved figure.
+
+    rasterized : boolean (optional)
+        If True, the arcs and nodes are rasterized even in vector formats,
+        which keeps files of huge pyramids small.  By default, they are
+        rasterized when G has more than 10000 nodes.
+
     Examples
     --------
     >>> import networkx as nx
@@ -116,26 +507,347 @@ def draw_pyramid_flow(G, pos, sinks):
     >>> plt.show()
 
     """
-    nodes = G.nodes()
-    labels = dict((node, '1/{}'.format(node[0] + 1)) for node in nodes
-                  if node != 't')
-    labels[(0, 0)] = '1'
-    labels['t'] = 't'
+    try:
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
+    except ImportError:
+        raise ImportError('draw_pyramid_flow requires matplotlib '
+                          '(http://matplotlib.org/)')
+
+    if isinstance(sinks, confluent.SinkTrees):
+        sinks = sinks.to_dict()
+    if ax is None:
+        ax = plt.gca()
+    if rasterized is None:
+        rasterized = len(G) > 10000
 
-    with_labels = True
+    segments = []
+    colors = []
     for sink in sinks:
         tree = sinks[sink]['tree_arcs']
-        color = sinks[sink]['color']
-        nx.draw(G, edgelist=tree, edge_color=[color] * len(tree),
-                node_color="#348ABD", pos=pos, width=4, alpha=0.9,
-                edge_cmap=plt.get_cmap('jet'), edge_vmin=0.0,
-                edge_vmax=len(sinks), arrows=False, nodelist=nodes,
-                node_size=600, font_color='w', labels=labels,
-                with_labels=with_labels, linewidths=0)
-        #nx.draw(G, edgelist=tree, edge_color='0.6', linewidths=0,
-                #node_color="#348ABD", pos=pos, width=4, alpha=0.9,
-                #arrows=False, nodelist=nodes,
-                #node_size=200, font_color='w', labels=labels,
-                #with_labels=False)
-        nodes = []
-        with_labels = False
+        segments.extend((pos[u], pos[v]) for u, v in tree)
+        colors.extend([sinks[sink]['color']] * len(tree))
+    arcs = LineCollection(segments, cmap=plt.get_cmap('jet'), linewidths=4,
+                          alpha=0.9, rasterized=rasterized)
+    arcs.set_array(colors)
+    arcs.set_clim(0.0, len(sinks))
+    ax.add_collection(arcs)
+
+    nodes = G.nodes()
+    ax.scatter([pos[v][0] for v in nodes], [pos[v][1] for v in nodes],
+               s=node_size, c="#348ABD", linewidths=0, zorder=2,
+               rasterized=rasterized)
+    if with_labels:
+        for v in nodes:
+            label = 't' if v == 't' else '1/{}'.format(v[0] + 1)
+            ax.text(pos[v][0], pos[v][1], '1' if v == (0, 0) else label,
+                    color='w', ha='center', va='center', zorder=3)
+    ax.autoscale_view()
+    ax.set_axis_off()
+    if filename is not None:
+        ax.figure.savefig(filename, dpi=dpi)
+
+
+# Instance families of the benchmark suite: generator of an instance of a
+# given size, sizes of the full suite and sizes of the quick suite.
+FAMILIES = {
+    'pyramid': (lambda N: pyramid(N)[0],
+                [10, 20, 50, 100, 200, 500], [10, 20, 40]),
+    'random_dag': (lambda n: random_dag(n, seed=n),
+                   [1000, 5000, 20000, 100000], [1000, 5000]),
+    'grid': (lambda n: grid(n, seed=n),
+             [10, 30, 100, 300], [10, 30]),
+    'random_sparse': (lambda n: random_sparse(n, nb_sinks=n // 20, seed=n),
+                      [1000, 5000, 20000, 100000], [1000, 5000]),
+    'layered_dag': (lambda n: to_networkx(*layered_dag_arrays(n // 100, 100,
+                                                              seed=n)),
+                    [1000, 5000, 20000, 100000], [1000, 5000]),
+}
+
+
+def run_instance(G, t='t', flow_func=None, engine='networkx', memory=True,
+                 method='exact', max_moves=0):
+    """Solve the confluent flow problem on G and measure the run.
+
+    Parameters
+    ----------
+    G : directed graph
+        Instance of the confluent flow problem.
+
+    t : node (optional, default = 't')
+        Sink node.
+
+    flow_func : function (optional, default = None)
+        Maximum flow function given to `confluent.confluent_flow`.
+
+    engine : string (optional, default = 'networkx')
+        Engine given to `confluent.confluent_flow`.
+
+    memory : boolean (optional, default = True)
+        If True, solve the problem a second time with `tracemalloc` enabled
+        to measure the peak memory allocated by the solver.
+
+    method, max_moves : (optional, default = 'exact', 0)
+        Method given to `confluent.confluent_flow`.
+
+    Returns
+    -------
+    run : dictionary
+        `times` maps the phases 'max_flow', 'support', 'main_loop' and 'total'
+        to their duration in seconds.  `steps` maps 'aggregate', 'sawtooth'
+        and 'pivot' to the number of nodes aggregated, sawtooth cycles
+        cancelled and pivots.
+        `peak_memory` is the peak memory in bytes, or None if `memory` is
+        False.  `nodes` and `arcs` give the size of G, `congestion` the
+        largest congestion of a sink and `lower_bound` the lower bound of
+        `confluent.congestion_lower_bound` on it, computed after the timed
+        run.
+
+    """
+    options = dict(flow_func=flow_func, engine=engine, method=method,
+                   max_moves=max_moves)
+    stats = confluent.Stats()
+    start = time.time()
+    confluent.confluent_flow(G, t, observer=stats, **options)
+    end = time.time()
+
+    peak_memory = None
+    if memory:
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            confluent.confluent_flow(G, t, **options)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {'nodes': len(G), 'arcs': G.number_of_edges(),
+            'times': dict(stats.phase_times, total=end - start),
+            'steps': {'aggregate': stats.aggregated,
+                      'sawtooth': stats.cycles,
+                      'pivot': stats.pivots},
+            'peak_memory': peak_memory,
+            'congestion': stats.congestion,
+            'lower_bound': confluent.congestion_lower_bound(
+                G, t, flow_func=flow_func)}
+
+
+def run_benchmark(families=None, quick=False, flow_func=None,
+                  engine='networkx', memory=True, budget=60.0, log=None,
+                  method='exact', max_moves=0):
+    """Run `run_instance` on every size of every family of `FAMILIES`.
+
+    Sizes are run in increasing order and the larger sizes of a family are
+    skipped once a run of this family takes more than `budget` seconds.
+
+    Parameters
+    ----------
+    families : list (optional)
+        Names of the families to run.  By default, all of them.
+
+    quick : boolean (optional, default = False)
+        If True, run the small sizes of the quick suite.
+
+    flow_func : string (optional)
+        Name of a maximum flow function of `flow_funcs`.  By default,
+        `nx.ford_fulkerson`.
+
+    engine : string (optional, default = 'networkx')
+        Engine given to `confluent.confluent_flow`.
+
+    memory : boolean (optional, default = True)
+        If True, measure the peak memory of every run.
+
+    budget : float (optional, default = 60.0)
+        Time in seconds after which the larger sizes of a family are skipped.
+
+    log : function (optional)
+        Function called with a line of text after every run.
+
+    method, max_moves : (optional, default = 'exact', 0)
+        Method given to `confluent.confluent_flow`.
+
+    Returns
+    -------
+    results : dictionary
+        `environment` describes the machine and the settings and `runs` is
+        the list of runs returned by `run_instance` with their `family` and
+        `size`.
+
+    """
+    if families is None:
+        families = sorted(FAMILIES)
+    func = None if flow_func is None else flow_funcs()[flow_func]
+    results = {'environment': {'python': platform.python_version(),
+                               'networkx': nx.__version__,
+                               'platform': platform.platform(),
+                               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                               'flow_func': flow_func or 'ford_fulkerson',
+                               'engine': engine, 'method': method,
+                               'max_moves': max_moves},
+               'runs': []}
+    for family in families:
+        generator, sizes, quick_sizes = FAMILIES[family]
+        for size in (quick_sizes if quick else sizes):
+            run = run_instance(generator(size), flow_func=func,
+                               engine=engine, memory=memory, method=method,
+                               max_moves=max_moves)
+            run['family'] = family
+            run['size'] = size
+            results['runs'].append(run)
+            if log is not None:
+                log(_format_run(run))
+            if run['times']['total'] > budget:
+                break
+    return results
+
+
+def _format_run(run):
+    memory = run['peak_memory']
+    return ('{family:14s}{size:>8d}{nodes:>9d}{arcs:>9d}'
+            '{max_flow:>10.3f}{support:>10.3f}{main_loop:>10.3f}'
+            '{aggregate:>10d}{sawtooth:>10d}{pivot:>10d}{memory:>10s}').format(
+                memory='n/a' if memory is None
+                else '{:.1f}M'.format(memory / 2.0**20),
+                **dict(run, **dict(run['times'], **run['steps'])))
+
+
+_HEADER = ('{:14s}{:>8s}{:>9s}{:>9s}{:>10s}{:>10s}{:>10s}'
+           '{:>10s}{:>10s}{:>10s}{:>10s}').format(
+               'family', 'size', 'nodes', 'arcs', 'max_flow', 'support',
+               'main_loop', 'aggregate', 'sawtooth', 'pivot', 'memory')
+
+
+def compare_results(baseline, results, threshold=0.25, min_time=0.05):
+    """Compare benchmark results to a baseline and return the list of
+    regressions, as lines of text.
+
+    A run regresses if one of its phases takes more than ``1 + threshold``
+    times as long as in the baseline, ignoring phases faster than `min_time`
+    seconds in both, or if its peak memory or the number of steps of its
+    main loop grows by more than the same factor.  Runs are matched by family
+    and size.
+
+    Examples
+    --------
+    >>> import benchmark
+    >>> base = {'runs': [{'family': 'grid', 'size': 10, 'peak_memory': 100,
+    ...                   'times': {'total': 1.0}}]}
+    >>> new = {'runs': [{'family': 'grid', 'size': 10, 'peak_memory': 100,
+    ...                  'times': {'total': 2.0}}]}
+    >>> benchmark.compare_results(base, new)
+    ['grid 10: total time 1.000s -> 2.000s (+100%)']
+
+    """
+    base_runs = dict(((run['family'], run['size']), run)
+                     for run in baseline['runs'])
+    regressions = []
+    for run in results['runs']:
+        key = run['family'], run['size']
+        if key not in base_runs:
+            continue
+        base = base_runs[key]
+        name = '{} {}'.format(*key)
+        for phase in sorted(run['times']):
+            old = base['times'].get(phase)
+            new = run['times'][phase]
+            if (old is not None and max(old, new) >= min_time and
+                    new > old * (1 + threshold)):
+                regressions.append(
+                    '{}: {} time {:.3f}s -> {:.3f}s (+{:.0%})'.format(
+                        name, phase, old, new, new / old - 1 if old else 1))
+        for step in sorted(run.get('steps', {})):
+            old = base.get('steps', {}).get(step)
+            new = run['steps'][step]
+            if old is not None and new > old * (1 + threshold) + 1:
+                regressions.append('{}: {} steps {} -> {}'.format(
+                    name, step, old, new))
+        old = base.get('peak_memory')
+        new = run.get('peak_memory')
+        if old and new and new > old * (1 + threshold):
+            regressions.append('{}: peak memory {:.1f}M -> {:.1f}M '
+                               '(+{:.0%})'.format(name, old / 2.0**20,
+                                                  new / 2.0**20,
+                                                  new / old - 1))
+    return regressions
+
+
+def main(argv=None):
+    """Command line interface of the benchmark suite.
+
+    Run ``python -m benchmark run --help`` and ``python -m benchmark compare
+    --help`` for the options.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmark',
+        description='Benchmark suite of the confluent flow algorithm.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run the benchmark suite')
+    run_parser.add_argument('-f', '--family', action='append',
+                            choices=sorted(FAMILIES),
+                            help='family of instances (default: all)')
+    run_parser.add_argument('-q', '--quick', action='store_true',
+                            help='run the small sizes only')
+    run_parser.add_argument('--flow-func', choices=sorted(flow_funcs()),
+                            help='maximum flow function')
+    run_parser.add_argument('--engine', default='networkx',
+                            choices=['networkx', 'array'])
+    run_parser.add_argument('--method', default='exact',
+                            choices=['exact', 'greedy'])
+    run_parser.add_argument('--max-moves', type=int, default=0,
+                            help='local improvements of the greedy method')
+    run_parser.add_argument('--no-memory', action='store_true',
+                            help='do not measure the peak memory')
+    run_parser.add_argument('--budget', type=float, default=60.0,
+                            help='seconds after which the larger sizes of a '
+                            'family are skipped (default: 60)')
+    run_parser.add_argument('-o', '--output',
+                            help='write the results to this JSON file')
+    run_parser.add_argument('-b', '--baseline',
+                            help='compare the results to this JSON file')
+    run_parser.add_argument('--threshold', type=float, default=0.25,
+                            help='relative slowdown reported as a regression '
+                            '(default: 0.25)')
+    compare_parser = commands.add_parser(
+        'compare', help='compare results to a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        print(_HEADER)
+        results = run_benchmark(families=args.family, quick=args.quick,
+                                flow_func=args.flow_func, engine=args.engine,
+                                memory=not args.no_memory,
+                                budget=args.budget, log=print,
+                                method=args.method,
+                                max_moves=args.max_moves)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if not args.baseline:
+            return 0
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+    else:
+        parser.print_help()
+        return 2
+
+    regressions = compare_results(baseline, results,
+                                  threshold=args.threshold)
+    for line in regressions:
+        print('REGRESSION ' + line)
+    if not regressions:
+        print('No regression.')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
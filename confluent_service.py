@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio service computing confluent flows on resident topologies.
+
+Requires Python >= 3.7.  Run ``python -m confluent_service --help`` to serve
+the array graphs saved by `confluent.ArrayGraph` on localhost.
+"""
+
+__author__ = """Loïc Séguin-C. <loicseguin@gmail.com>"""
+# Copyright (C) 2013 Loïc Séguin-C. <loicseguin@gmail.com>
+# All rights reserved.
+# BSD license.
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import threading
+
+import networkx as nx
+
+import confluent
+
+
+class ServiceBusy(nx.NetworkXException):
+    """Raised when a request would start a new solve while `max_pending`
+    solves are already waiting or running.
+
+    """
+
+
+class SolveService(object):
+    """Compute confluent flows on resident topologies off the event loop.
+
+    Topologies are registered once with `add_topology` and every request
+    only names one, with its sink and demands.  Solves run in a pool of
+    threads, or of worker processes that receive the topologies once when
+    they start, as in `confluent.confluent_flow_many`.  The maximum flow
+    network of a topology and sink is set up once and reused by the solves
+    of all the demand vectors on them.
+
+    Worker processes cannot receive a topology after they started: adding
+    or replacing a topology shuts them down and the next request starts new
+    ones, to which every topology is sent again.  With `processes`, the
+    topologies should thus be added before the requests are served.
+    Removing a topology does not restart the workers.
+
+    Concurrent requests for the same topology, sink and positive demands
+    share a single solve.  At most `max_pending` distinct solves wait or
+    run at the same time; further requests raise `ServiceBusy` immediately
+    instead of queueing without bound.  A request that takes longer than
+    its timeout raises `asyncio.TimeoutError`.  The solve is cancelled if
+    no other request waits for it and no worker has started it yet.  A
+    service is used from a single event loop.
+
+    Parameters
+    ----------
+    processes : integer (optional, default = None)
+        Number of worker processes.  Adding a topology restarts them.
+
+    threads : integer (optional, default = None)
+        Number of worker threads, used when `processes` is not given.  The
+        default is the number of CPUs.
+
+    max_pending : integer (optional, default = 64)
+        Maximum number of distinct solves waiting or running.
+
+    timeout : float (optional, default = None)
+        Default timeout of the requests, in seconds.
+
+    flow_func, engine
+        As in `confluent.confluent_flow`.  With `processes`, `flow_func` must
+        be picklable.
+
+    Attributes
+    ----------
+    requests, solves, coalesced, rejected, timeouts : integers
+        Number of requests received, of solves started, of requests served
+        by the solve of another one, of requests rejected by `ServiceBusy`
+        and of requests that timed out.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> import benchmark
+    >>> import confluent_service
+    >>> service = confluent_service.SolveService(threads=2)
+    >>> service.add_topology('digraph1', benchmark.digraph1(), 't')
+    >>> async def solve_three():
+    ...     return await asyncio.gather(
+    ...         *[service.solve('digraph1') for _ in range(3)])
+    >>> results = asyncio.run(solve_three())
+    >>> sorted(results[0]), service.solves, service.coalesced
+    ([8, 9, 10], 1, 2)
+    >>> service.close()
+
+    """
+    def __init__(self, processes=None, threads=None, max_pending=64,
+                 timeout=None, flow_func=None, engine='networkx'):
+        confluent._check_engine(engine)
+        if processes is not None and threads is not None:
+            raise nx.NetworkXError('Give either processes or threads.')
+        self.processes = processes
+        self.workers = processes or threads or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.flow_func = flow_func
+        self.engine = engine
+        self.requests = 0
+        self.solves = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._topologies = {}
+        self._versions = {}
+        self._executor = None
+        self._slots = None
+        self._jobs = {}
+        self._waiters = {}
+        # Idle solvers of the worker threads by topology, version and sink.
+        self._solvers = {}
+        self._lock = threading.Lock()
+
+    def add_topology(self, name, G, t=None):
+        """Keep the DiGraph G resident under `name`, with `t` as the default
+        sink of its requests.  Requests already received for a previous
+        topology of that name are still answered with it.
+
+        """
+        if not G.is_directed() or G.is_multigraph():
+            raise nx.NetworkXError('SolveService requires DiGraphs.')
+        with self._lock:
+            self._topologies[name] = (G, t)
+            self._versions[name] = self._versions.get(name, 0) + 1
+            self._drop_solvers(name)
+        if self.processes is not None:
+            self._shutdown_executor()
+
+    def remove_topology(self, name):
+        """Forget the topology `name`.  Worker processes keep their copy of
+        it until they are restarted.
+
+        """
+        with self._lock:
+            del self._topologies[name]
+            self._drop_solvers(name)
+
+    def _drop_solvers(self, name):
+        for key in [key for key in self._solvers if key[0] == name]:
+            del self._solvers[key]
+
+    def topologies(self):
+        """Return the sorted list of the names of the topologies."""
+        return sorted(self._topologies)
+
+    def stats(self):
+        """Return the counters of the service as a dictionary."""
+        return {'requests': self.requests, 'solves': self.solves,
+                'coalesced': self.coalesced, 'rejected': self.rejected,
+                'timeouts': self.timeouts, 'pending': len(self._jobs)}
+
+    async def solve(self, name, t=None, demands=None, timeout=None):
+        """Return the sink trees of a confluent flow on the topology `name`.
+
+        Parameters
+        ----------
+        name : string
+            Name of the topology.
+
+        t : node (optional, default = None)
+            Sink, by default the one given to `add_topology`.
+
+        demands : dictionary (optional, default = None)
+            Demand of the nodes, as in `confluent.confluent_flow_many`.  By
+            default, the demands are read from the nodes of the topology.
+            Nodes without a positive demand and the sink are ignored.
+
+        timeout : float (optional, default = None)
+            Seconds after which `asyncio.TimeoutError` is raised, by default
+            the timeout of the service.
+
+        Returns
+        -------
+        sinks : dictionary
+            As returned by `confluent.confluent_flow`.  Coalesced requests
+            share this dictionary, which must not be modified.
+
+        """
+        if name not in self._topologies:
+            raise nx.NetworkXError('Unknown topology {}.'.format(name))
+        self.requests += 1
+        if t is None:
+            t = self._topologies[name][1]
+        if demands is not None:
+            # Zero demands do not change the flow, so they are dropped for
+            # the requests that only differ by them to share a solve.
+            demands = dict((v, d) for v, d in demands.items()
+                           if d > 0 and v != t)
+        key = (name, self._versions[name], t,
+               None if demands is None else frozenset(demands.items()))
+        job = self._jobs.get(key)
+        if job is None:
+            if len(self._jobs) >= self.max_pending:
+                self.rejected += 1
+                raise ServiceBusy('{} solves are already pending.'.format(
+                    len(self._jobs)))
+            job = asyncio.ensure_future(self._run(name, t, demands))
+            self._jobs[key] = job
+            job.add_done_callback(functools.partial(self._forget, key))
+        else:
+            self.coalesced += 1
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(job), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not job.done():
+                    self._forget(key, job)
+                    job.cancel()
+
+    def _forget(self, key, job):
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+
+    async def _run(self, name, t, demands):
+        """Wait for a free worker and solve on it."""
+        loop = asyncio.get_event_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        await self._slots.acquire()
+        try:
+            future = self._submit(name, t, demands)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is only freed when the worker is done, even if the job is
+        # cancelled while running.
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._slots.release))
+        self.solves += 1
+        return await asyncio.wrap_future(future)
+
+    def _submit(self, name, t, demands):
+        if self._executor is None:
+            if self.processes is not None:
+                topologies = dict((k, G) for k, (G, _) in
+                                  self._topologies.items())
+                # Forked workers would inherit the sockets of the open
+                # connections and keep them open after the server closes them.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_service_worker,
+                    initargs=(topologies, self.flow_func, self.engine))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        if self.processes is not None:
+            return self._executor.submit(_worker_solve, name, t, demands)
+        return self._executor.submit(
+            self._thread_solve, (name, self._versions[name], t),
+            self._topologies[name][0], demands)
+
+    def _thread_solve(self, key, G, demands):
+        """Solve in a worker thread with an idle solver of the topology and
+        sink of `key`, which is put back once done.
+
+        """
+        name, version, t = key
+        if demands is None:
+            return confluent.confluent_flow(G, t, flow_func=self.flow_func,
+                                            engine=self.engine)
+        with self._lock:
+            idle = self._solvers.get(key)
+            solver = idle.pop() if idle else None
+        if solver is None:
+            solver = _demand_solver(G, t, self.flow_func, self.engine)
+        sinks = solver.solve(demands)
+        with self._lock:
+            if name in self._topologies and self._versions[name] == version:
+                self._solvers.setdefault(key, []).append(solver)
+        return sinks
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def close(self, wait=True):
+        """Stop the workers, after their current solves if `wait` is True."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+def _demand_solver(G, t, flow_func, engine):
+    """Return a solver of the demand vectors on G towards `t`."""
+    if t not in G:
+        raise nx.NetworkXError('node {} not in graph'.format(t))
+    return confluent._DemandSolver(G, t, 'demand', 'capacity', flow_func,
+                                   engine)
+
+
+# Topologies, maximum flow function and engine of a worker process, and its
+# solvers by topology and sink.
+_worker_args = None
+_worker_solvers = None
+
+
+def _init_service_worker(*args):
+    global _worker_args, _worker_solvers
+    _worker_args = args
+    _worker_solvers = {}
+
+
+def _worker_solve(name, t, demands):
+    topologies, flow_func, engine = _worker_args
+    G = topologies[name]
+    if demands is None:
+        return confluent.confluent_flow(G, t, flow_func=flow_func,
+                                        engine=engine)
+    solver = _worker_solvers.get((name, t))
+    if solver is None:
+        solver = _demand_solver(G, t, flow_func, engine)
+        _worker_solvers[name, t] = solver
+    return solver.solve(demands)
+
+
+async def serve(service, host='127.0.0.1', port=8765):
+    """Serve the requests of `service` on a TCP socket and return the
+    `asyncio.Server`.
+
+    The protocol is one JSON object per line.  A request holds the
+    ``topology``, and optionally the sink ``t``, the ``demands`` as a list of
+    ``[node, demand]`` pairs, a ``timeout`` and an ``id``.  Node labels that
+    are JSON lists are converted to tuples.  The response holds the same
+    ``id`` and either the ``sinks`` as a list of ``[sink, congestion,
+    tree_arcs]`` triples or an ``error``: ``"busy"``, ``"timeout"`` or a
+    message.  Requests of a connection are served concurrently, so responses
+    can come out of order.
+
+    """
+    return await asyncio.start_server(functools.partial(_handle, service),
+                                      host, port)
+
+
+async def _handle(service, reader, writer):
+    answers = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        answers.append(asyncio.ensure_future(_answer(service, line, writer)))
+        answers = [a for a in answers if not a.done()]
+    if answers:
+        await asyncio.wait(answers)
+    writer.close()
+
+
+async def _answer(service, line, writer):
+    response = {}
+    try:
+        request = json.loads(line.decode('utf-8'))
+        response['id'] = request.get('id')
+        demands = request.get('demands')
+        if demands is not None:
+            demands = dict((_node(v), d) for v, d in demands)
+        sinks = await service.solve(request['topology'],
+                                    _node(request.get('t')), demands,
+                                    timeout=request.get('timeout'))
+        response['sinks'] = [[v, d['congestion'], d['tree_arcs']]
+                             for v, d in sinks.items()]
+    except ServiceBusy:
+        response['error'] = 'busy'
+    except asyncio.TimeoutError:
+        response['error'] = 'timeout'
+    except Exception as e:
+        response['error'] = str(e) or e.__class__.__name__
+    writer.write((json.dumps(response, default=float) + '\n').encode('utf-8'))
+
+
+async def query(requests, host='127.0.0.1', port=8765):
+    """Send the `requests`, dictionaries in the format of `serve`, over one
+    connection and return the list of the responses in the order in which
+    they arrive.
+
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    for request in requests:
+        writer.write((json.dumps(request) + '\n').encode('utf-8'))
+    writer.write_eof()
+    responses = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        responses.append(json.loads(line.decode('utf-8')))
+    writer.close()
+    return responses
+
+
+def _node(v):
+    """Return the node label `v` decoded from JSON."""
+    if isinstance(v, list):
+        return tuple(_node(x) for x in v)
+    return v
+
+
+def main(argv=None):
+    """Command line interface.  Run ``python -m confluent_service --help``
+    for the options.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m confluent_service',
+        description='Serve confluent flows of array graphs on localhost.')
+    parser.add_argument('-g', '--topology', action='append', required=True,
+                        metavar='NAME=DIRECTORY',
+                        help='array graph saved by confluent.ArrayGraph')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes (default: threads)')
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--max-pending', type=int, default=64)
+    parser.add_argument('--timeout', type=float,
+                        help='default timeout of the requests in seconds')
+    parser.add_argument('--engine', default='networkx',
+                        choices=['networkx', 'array'])
+    parser.add_argument('--csgraph', action='store_true',
+                        help='compute maximum flows with SciPy')
+    args = parser.parse_args(argv)
+
+    service = SolveService(
+        processes=args.processes, threads=args.threads,
+        max_pending=args.max_pending, timeout=args.timeout,
+        flow_func=confluent.csgraph_maximum_flow if args.csgraph else None,
+        engine=args.engine)
+    for topology in args.topology:
+        name, _, path = topology.partition('=')
+        G, t = confluent.ArrayGraph.load(path).to_networkx()
+        service.add_topology(name, G, t)
+
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(serve(service, args.host, args.port))
+    print('Serving {} on {}:{}'.format(', '.join(service.topologies()),
+                                       args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
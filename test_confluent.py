@@ -10,7 +10,9 @@ __author__ = """Loïc Séguin-C. <loicseguin@gmail.com>"""
 # BSD license.
 
 
+from fractions import Fraction
 import networkx as nx
+from nose import SkipTest
 from nose.tools import *
 import confluent
 
@@ -46,6 +48,31 @@ class TestConfluent:
         for v in free_nodes:
             assert_equal(H.node[v]['color'], -1)
 
+    def test_aggregate_chain(self):
+        H = nx.DiGraph()
+        H.add_edges_from([(0, 1), (1, 2), (2, 3), (3, 't1'), (4, 3), (4, 't2')])
+        for v in H:
+            H.node[v]['color'] = -1
+        H.node['t1']['color'] = 0
+        H.node['t2']['color'] = 1
+        sinks = {'t1': {'color': 0, 'tree_arcs': []},
+                 't2': {'color': 1, 'tree_arcs': []}}
+        sink_for_color = ['t1', 't2']
+        frontier_nodes = set((3, 4))
+        free_nodes = set(range(5))
+        index = confluent._ColorIndex(H, sinks, frontier_nodes, free_nodes)
+
+        assert_true(confluent._aggregate(H, sinks, frontier_nodes, free_nodes,
+                                         sink_for_color, index=index))
+        assert_equal(sinks['t1']['tree_arcs'],
+                     [(3, 't1'), (2, 3), (1, 2), (0, 1)])
+        assert_equal(free_nodes, set((4,)))
+        assert_equal(frontier_nodes, set((4,)))
+        assert_equal(index.color_arcs[4], {0: set((3,)), 1: set(('t2',))})
+        assert_false(confluent._aggregate(H, sinks, frontier_nodes,
+                                          free_nodes, sink_for_color,
+                                          index=index))
+
     def test_break_sawtooth(self):
         H = nx.DiGraph()
         H.add_weighted_edges_from([(0, 1, 3), (0, 2, 1), (1, 3, 3), (2, 6, 2),
@@ -103,6 +130,57 @@ class TestConfluent:
                              (5, 9, {'weight': 3}), (6, 9, {'weight': 2}),
                              (6, 10, {'weight': 1}), (7, 10, {'weight': 2})]))
 
+    def test_break_sawtooth_batch(self):
+        # Two disjoint copies of the instance of test_break_sawtooth.
+        H = nx.DiGraph()
+        arcs = [(0, 1, 3), (0, 2, 1), (1, 3, 3), (2, 6, 2), (3, 10, 3),
+                (3, 7, 1), (4, 8, 1), (5, 4, 1), (5, 9, 2), (6, 9, 3),
+                (6, 10, 1), (7, 10, 2)]
+        H.add_weighted_edges_from(arcs)
+        H.add_weighted_edges_from([(u + 20, v + 20, w) for u, v, w in arcs])
+        for v in H:
+            H.node[v]['color'] = -1
+        sinks = {}
+        for offset, first_color in ((0, 1), (20, 4)):
+            for v in (4, 8):
+                H.node[v + offset]['color'] = first_color
+            H.node[9 + offset]['color'] = first_color + 1
+            for v in (1, 3, 7, 10):
+                H.node[v + offset]['color'] = first_color + 2
+            for i, v in enumerate((8, 9, 10)):
+                sinks[v + offset] = {'color': first_color + i,
+                                     'tree_arcs': []}
+        frontier_nodes = set((0, 2, 5, 6, 20, 22, 25, 26))
+        free_nodes = set(frontier_nodes)
+        res = confluent._break_sawtooth(H, sinks, frontier_nodes, free_nodes,
+                                        batch=True)
+        assert_equal(res, 4)
+        assert_false(H.has_edge(0, 2))
+        assert_false(H.has_edge(20, 22))
+        assert_equal(H[0][1]['weight'], 4)
+        assert_equal(H[20][21]['weight'], 4)
+        assert_equal(confluent._break_sawtooth(H, sinks, frontier_nodes,
+                                               free_nodes, batch=True), 0)
+
+    def test_break_sawtooth_drains_node(self):
+        H = nx.DiGraph()
+        H.add_weighted_edges_from([(0, 1, 1), (1, 'a', 1), (0, 'b', 1),
+                                   (2, 'a', 1), (2, 'b', 1)])
+        for v in H:
+            H.node[v]['color'] = -1
+        H.node['a']['color'] = 0
+        H.node['b']['color'] = 1
+        sinks = {'a': {'color': 0, 'tree_arcs': []},
+                 'b': {'color': 1, 'tree_arcs': []}}
+        frontier_nodes = set((0, 1, 2))
+        free_nodes = set((0, 1, 2))
+        res = confluent._break_sawtooth(H, sinks, frontier_nodes, free_nodes)
+        assert_true(res)
+        assert_equal(sorted(H.edges(data=True), key=str),
+                     [(0, 'b', {'weight': 2}), (2, 'a', {'weight': 2})])
+        assert_equal(free_nodes, set((0, 2)))
+        assert_equal(frontier_nodes, set((0, 2)))
+
     def test_pivot(self):
         H = nx.DiGraph()
         H.add_weighted_edges_from([
@@ -181,6 +259,43 @@ class TestConfluent:
                       7: {'color': 2, 'tree_arcs': [], 'congestion': 1},
                       8: {'color': 3, 'tree_arcs': [], 'congestion': 0}})
 
+    def test_pivot_none(self):
+        H = nx.DiGraph()
+        H.add_weighted_edges_from([(6, 7, 1), (6, 8, 1), (9, 7, 1),
+                                   (9, 8, 1)])
+        for v in H:
+            H.node[v]['color'] = -1
+        H.node[7]['color'] = 0
+        H.node[8]['color'] = 1
+        sinks = {7: {'color': 0, 'tree_arcs': [], 'congestion': 1},
+                 8: {'color': 1, 'tree_arcs': [], 'congestion': 1}}
+        frontier_nodes = set((6, 9))
+        free_nodes = [6, 9]
+        res = confluent._pivot(H, sinks, frontier_nodes, free_nodes, [7, 8])
+        assert_false(res)
+        assert_equal(H.number_of_edges(), 4)
+
+    def test_pivot_order(self):
+        # The index finds the pivot that the scan of the sinks finds.
+        import benchmark
+        instances = [benchmark.random_dag(11, nb_sinks=4, seed=89938),
+                     benchmark.random_dag(24, nb_sinks=3, seed=204563)]
+        for seed in range(30):
+            instances.append(benchmark.random_dag(12 + seed, nb_sinks=3,
+                                                  seed=seed))
+            instances.append(benchmark.random_sparse(12 + seed, nb_sinks=3,
+                                                     seed=seed))
+        pivot = confluent._pivot
+        try:
+            for G in instances:
+                confluent._pivot = pivot
+                expected = confluent.confluent_flow(G, 't')
+                confluent._pivot = _scanning_pivot
+                sinks = confluent.confluent_flow(G, 't')
+                assert_equal(sinks, expected)
+        finally:
+            confluent._pivot = pivot
+
     def test_confluent(self):
         G = nx.DiGraph()
         G.add_weighted_edges_from([(0, 1, 3), (0, 2, 1), (1, 3, 3),
@@ -202,11 +317,851 @@ class TestConfluent:
         G.node[10]['demand'] = 2
 
         sinks = confluent.confluent_flow(G, 't')
-        assert_equal(sinks[8]['congestion'], 1)
-        assert_equal(sorted(sinks[8]['tree_arcs']), [(4, 8)])
-        assert_equal(sinks[9]['congestion'], 7)
-        assert_equal(sorted(sinks[9]['tree_arcs']),
-                     [(2, 6), (5, 9), (6, 9)])
+        assert_equal(sinks[8]['congestion'], 5)
+        assert_equal(sorted(sinks[8]['tree_arcs']), [(4, 8), (5, 4)])
+        assert_equal(sinks[9]['congestion'], 3)
+        assert_equal(sorted(sinks[9]['tree_arcs']), [(2, 6), (6, 9)])
         assert_equal(sinks[10]['congestion'], 8)
         assert_equal(sorted(sinks[10]['tree_arcs']),
                      [(0, 1), (1, 3), (3, 10), (7, 10)])
+
+    def test_confluent_array_engine(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest('NumPy not available.')
+        sinks = confluent.confluent_flow(_digraph1(), 't', engine='array')
+        assert_equal(sorted(sinks), [8, 9, 10])
+        assert_equal(sum(sinks[v]['congestion'] for v in sinks), 16)
+        tails = [u for v in sinks for u, _ in sinks[v]['tree_arcs']]
+        assert_equal(sorted(tails), [0, 1, 2, 3, 4, 5, 6, 7])
+
+    def test_confluent_does_not_modify_graph(self):
+        G = _digraph1()
+        nodes = sorted(G.nodes(data=True), key=str)
+        edges = sorted(G.edges(data=True), key=str)
+        confluent.confluent_flow(G, 't')
+        assert_equal(sorted(G.nodes(data=True), key=str), nodes)
+        assert_equal(sorted(G.edges(data=True), key=str), edges)
+
+        def failing_flow(G, s, t, capacity='capacity'):
+            raise RuntimeError('no flow')
+        assert_raises(RuntimeError, confluent.confluent_flow, G, 't',
+                      flow_func=failing_flow)
+        assert_equal(sorted(G.nodes(data=True), key=str), nodes)
+        assert_equal(sorted(G.edges(data=True), key=str), edges)
+
+    def test_confluent_flow_many(self):
+        G = _digraph1()
+        demands = dict((v, G.node[v]['demand']) for v in G if v != 't')
+        for v in G:
+            G.node[v].pop('demand', None)
+        small = {5: 1}
+        results = list(confluent.confluent_flow_many(G, 't',
+                                                     [demands, small]))
+        assert_equal(len(results), 2)
+        assert_equal(sum(results[0][v]['congestion'] for v in results[0]), 16)
+        assert_equal(sum(results[1][v]['congestion'] for v in results[1]), 1)
+        assert_equal(results[0], confluent.confluent_flow(_digraph1(), 't'))
+
+    def test_confluent_flow_many_processes(self):
+        G = _digraph1()
+        demands = dict((v, G.node[v]['demand']) for v in G if v != 't')
+        results = list(confluent.confluent_flow_many(
+            G, 't', [demands, {5: 1}, demands], processes=2))
+        assert_equal([sorted(sinks) for sinks in results],
+                     [[8, 9, 10], [9], [8, 9, 10]])
+        for sinks, total in zip(results, [16, 1, 16]):
+            assert_equal(sum(sinks[v]['congestion'] for v in sinks), total)
+
+        # The demand vectors are read as the results are consumed.
+        read = []
+
+        def snapshots():
+            for i in range(100):
+                read.append(i)
+                yield {5: 1}
+        results = confluent.confluent_flow_many(G, 't', snapshots(),
+                                                processes=1)
+        assert_equal(sorted(next(results)), [9])
+        assert_true(len(read) <= 3)
+        results.close()
+
+    def test_confluent_flow_update(self):
+        G = _digraph1()
+        sinks, flow = confluent.confluent_flow(G, 't', return_flow=True)
+        assert_equal(flow.graph['unmet'], set())
+        assert_equal(sum(flow.node[v]['served'] for v in flow if v != 't'),
+                     16)
+
+        # Node 5 cannot send more than 4 units, so one unit is not served.
+        G.node[5]['demand'] = 5
+        G[0][1]['capacity'] = 1
+        sinks, flow = confluent.confluent_flow_update(
+            G, 't', sinks, flow, nodes=[5], arcs=[(0, 1)])
+        assert_equal(flow.graph['unmet'], set([0, 5]))
+        assert_equal(flow.node[0]['served'], 2)
+        assert_equal(flow.node[5]['served'], 4)
+        for u, v, d in flow.edges_iter(data=True):
+            assert_true(0 < d['weight'] <= G[u][v]['capacity'])
+        assert_equal(sum(sinks[v]['congestion'] for v in sinks), 14)
+        tails = [u for v in sinks for u, _ in sinks[v]['tree_arcs']]
+        assert_equal(len(tails), len(set(tails)))
+        for v in sinks:
+            for u, _ in sinks[v]['tree_arcs']:
+                assert_equal(flow.node[u]['sink'], v)
+
+    def test_confluent_flow_update_round_off(self):
+        # The flow on (u, t) is 0.1 + 0.2, slightly more than the demands
+        # it serves, so cancelling it leaves a residue with no path.
+        G = nx.DiGraph()
+        G.add_edge('a', 'u', capacity=1.5)
+        G.add_edge('b', 'u', capacity=1.5)
+        G.add_edge('u', 't', capacity=0.5)
+        G.node['a']['demand'] = 0.1
+        G.node['b']['demand'] = 0.2
+        flow = nx.DiGraph(unmet=set())
+        flow.add_edge('a', 'u', weight=0.1)
+        flow.add_edge('b', 'u', weight=0.2)
+        flow.add_edge('u', 't', weight=0.1 + 0.2)
+        for v, served in (('a', 0.1), ('b', 0.2), ('u', 0)):
+            flow.node[v].update(demand=served, served=served, sink='u')
+        sinks = {'u': {'congestion': 0.1 + 0.2,
+                       'tree_arcs': [('a', 'u'), ('b', 'u')], 'color': 0}}
+        G['u']['t']['capacity'] = 0
+        sinks, flow = confluent.confluent_flow_update(
+            G, 't', sinks, flow, arcs=[('u', 't')])
+        assert_equal(sinks, {})
+        assert_equal(flow.graph['unmet'], set(['a', 'b']))
+        assert_equal(flow.number_of_edges(), 0)
+
+    def test_confluent_processes(self):
+        # Two copies of the same network, solved in worker processes, and a
+        # single node, solved inline, that only share the sink.
+        G = _digraph1()
+        G.add_edges_from([(('b', u), ('b', v) if v != 't' else v, d)
+                          for u, v, d in G.edges(data=True)])
+        for v in range(11):
+            G.node[('b', v)]['demand'] = G.node[v]['demand']
+        G.add_edge('c', 't', capacity=1)
+        G.node['c']['demand'] = 1
+        min_nodes = confluent.PARALLEL_MIN_NODES
+        confluent.PARALLEL_MIN_NODES = 11
+        try:
+            sinks = confluent.confluent_flow(G, 't', processes=2)
+        finally:
+            confluent.PARALLEL_MIN_NODES = min_nodes
+        assert_equal(len(sinks), 7)
+        assert_equal(sorted(sinks[v]['color'] for v in sinks), list(range(7)))
+        assert_equal(sum(sinks[v]['congestion'] for v in sinks), 33)
+        for v in range(8, 11):
+            assert_equal(sinks[v]['congestion'],
+                         sinks[('b', v)]['congestion'])
+
+    def test_observer(self):
+        class Recorder(confluent.Observer):
+            def __init__(self):
+                self.events = []
+
+            def phase_started(self, phase, timestamp):
+                self.events.append(('start', phase))
+
+            def phase_ended(self, phase, timestamp):
+                self.events.append(('end', phase))
+
+            def node_aggregated(self, node, sink):
+                self.events.append(('aggregated', node))
+
+            def cycle_cancelled(self, cycle, flow, deleted_arcs):
+                assert_true(flow > 0)
+                assert_true(deleted_arcs)
+                self.events.append(('cycle', len(cycle)))
+
+            def pivoted(self, node, from_sink, to_sink, flow, deactivated):
+                assert_not_equal(from_sink, to_sink)
+                self.events.append(('pivot', node))
+
+        for engine in ('networkx', 'array'):
+            recorder = Recorder()
+            confluent.confluent_flow(_digraph1(), 't', observer=recorder,
+                                     engine=engine)
+            events = recorder.events
+            assert_equal([e for e in events if e[0] in ('start', 'end')],
+                         [('start', 'max_flow'), ('end', 'max_flow'),
+                          ('start', 'support'), ('end', 'support'),
+                          ('start', 'main_loop'), ('end', 'main_loop')])
+            assert_equal(sorted(v for e, v in events if e == 'aggregated'),
+                         list(range(8)))
+
+        stats = confluent.Stats()
+        confluent.confluent_flow(_digraph1(), 't', observer=stats)
+        assert_equal(stats.aggregated, 8)
+        assert_equal(stats.cycles, 2)
+        assert_equal(stats.pivots, 2)
+        assert_equal(sorted(stats.phase_times),
+                     ['main_loop', 'max_flow', 'support'])
+        assert_equal(stats.congestion, 8)
+        assert_equal(stats.lower_bound, None)
+        stats = confluent.Stats()
+        confluent.confluent_flow(_digraph1(), 't', observer=stats,
+                                 report=True)
+        assert_equal(sorted(stats.phase_times),
+                     ['bound', 'main_loop', 'max_flow', 'support'])
+        assert_equal(stats.lower_bound, 6)
+
+    def test_confluent_arithmetic(self):
+        G = nx.DiGraph()
+        G.add_edges_from([('a', 't'), ('b', 't'), ('c', 'a'), ('c', 'b')])
+        for v in 'abc':
+            G.node[v]['demand'] = 0.1
+        sinks = confluent.confluent_flow(G, 't', arithmetic='fraction')
+        assert_equal(sum(sinks[v]['congestion'] for v in sinks),
+                     Fraction(3, 10))
+        sinks = confluent.confluent_flow(G, 't', arithmetic='integer')
+        assert_equal(sorted(sinks[v]['congestion'] for v in sinks),
+                     [0.1, 0.2])
+        assert_equal(G.node['a']['demand'], 0.1)
+        assert_raises(nx.NetworkXError, confluent.confluent_flow, G, 't',
+                      arithmetic='integer', return_flow=True)
+        assert_raises(nx.NetworkXError, confluent.confluent_flow, G, 't',
+                      arithmetic='decimal')
+
+    def test_confluent_early_stop(self):
+        G = _digraph1()
+        for engine in ('networkx', 'array'):
+            stats = confluent.Stats()
+            sinks = confluent.confluent_flow(G, 't', engine=engine,
+                                             max_iterations=0, observer=stats)
+            assert_true(stats.attached > 0)
+            tails = [u for v in sinks for u, w in sinks[v]['tree_arcs']]
+            assert_equal(sorted(tails + list(sinks)), list(range(11)))
+            assert_equal(sum(sinks[v]['congestion'] for v in sinks), 16)
+        sinks = confluent.confluent_flow(G, 't', time_budget=60)
+        assert_equal(sorted(sinks[v]['congestion'] for v in sinks),
+                     [3, 5, 8])
+
+    def test_iter_confluent_flow(self):
+        for engine in ('networkx', 'array'):
+            nb_free = []
+            for state in confluent.iter_confluent_flow(_digraph1(), 't',
+                                                       engine=engine):
+                nb_free.append(state.nb_free)
+            assert_equal(state.steps, len(nb_free) - 1)
+            assert_equal(nb_free[-1], 0)
+            sinks = state.sinks()
+            assert_equal(sorted(sinks[v]['congestion'] for v in sinks),
+                         [3, 5, 8])
+            assert_equal(state.max_congestion(), 8)
+            assert_equal(state.sink_trees().path(0), [0, 1, 3, 10])
+
+            # Stopped after the first step, the free nodes are attached
+            # greedily and the iteration ends.
+            G = _digraph1()
+            steps = confluent.iter_confluent_flow(G, 't', engine=engine,
+                                                  report=True)
+            next(steps)
+            state = next(steps)
+            assert_true(state.nb_free > 0)
+            sinks, report = state.complete()
+            assert_equal(state.nb_free, 0)
+            assert_equal(list(steps), [])
+            assert_equal(confluent.verify_confluent_flow(G, 't', sinks), [])
+            assert_equal(report['congestion'],
+                         max(d['congestion'] for d in sinks.values()))
+            assert_equal(report['lower_bound'], 6)
+
+    def test_confluent_compact(self):
+        G = _digraph1()
+        expected = confluent.confluent_flow(G, 't')
+        for engine in ('networkx', 'array'):
+            trees = confluent.confluent_flow(G, 't', engine=engine,
+                                             compact=True)
+            assert_equal(trees.next_hop(0), 1)
+            assert_equal(trees.next_hop(10), 't')
+            assert_equal(trees.path(2), [2, 6, 9])
+            assert_equal(trees.sink(4), 8)
+            assert_equal(trees.congestion_of(9), 3)
+            sinks = trees.to_dict()
+            for v in expected:
+                assert_equal(sorted(sinks[v]['tree_arcs']),
+                             sorted(expected[v]['tree_arcs']))
+                assert_equal(sinks[v]['congestion'],
+                             expected[v]['congestion'])
+        trees = confluent.SinkTrees.from_dict(expected)
+        assert_equal(trees.next_hop(10), None)
+        assert_equal(trees.sink('x'), None)
+        assert_equal(trees.path('x'), [])
+
+    def test_solve_cache(self):
+        G = _digraph1()
+        cache = confluent.SolveCache(max_entries=3)
+        sinks = confluent.confluent_flow(G, 't', cache=cache)
+        assert_equal((cache.hits, cache.misses), (0, 2))
+        sinks['extra'] = None
+        cached = confluent.confluent_flow(G, 't', cache=cache)
+        assert_equal((cache.hits, cache.misses), (1, 2))
+        assert_false('extra' in cached)
+        confluent.confluent_flow(G, 't', engine='array', cache=cache)
+        assert_equal((cache.hits, cache.misses), (2, 3))
+        G.node[0]['demand'] = 3
+        confluent.confluent_flow(G, 't', cache=cache)
+        assert_equal(len(cache), 3)
+        assert_equal(cache.evictions, 2)
+        cache = confluent.SolveCache(max_bytes=1)
+        confluent.confluent_flow(G, 't', cache=cache)
+        assert_equal(cache.stats()['entries'], 0)
+
+    def test_solve_cache_fingerprint(self):
+        G = _digraph1()
+        reordered = nx.DiGraph()
+        reordered.add_nodes_from(reversed(G.nodes(data=True)))
+        reordered.add_edges_from(reversed(G.edges(data=True)))
+        assert_equal(confluent._fingerprint(reordered, 't'),
+                     confluent._fingerprint(G, 't'))
+        relabeled = nx.relabel_nodes(G, {0: '0'})
+        assert_not_equal(confluent._fingerprint(relabeled, 't'),
+                         confluent._fingerprint(G, 't'))
+        G[0][1]['capacity'] = 3.0
+        assert_not_equal(confluent._fingerprint(G, 't'),
+                         confluent._fingerprint(reordered, 't'))
+
+        # Nodes whose reprs are equal but whose states differ.
+        H = nx.DiGraph()
+        H.add_edge(_Node(1), 't')
+        K = nx.DiGraph()
+        K.add_edge(_Node(2), 't')
+        assert_not_equal(confluent._fingerprint(H, 't'),
+                         confluent._fingerprint(K, 't'))
+
+    def test_solve_cache_directory(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            G = _digraph1()
+            sinks = confluent.confluent_flow(
+                G, 't', cache=confluent.SolveCache(directory=directory))
+            cache = confluent.SolveCache(directory=directory)
+            assert_equal(confluent.confluent_flow(G, 't', cache=cache), sinks)
+            assert_equal((cache.hits, cache.misses), (1, 0))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_verify_confluent_flow(self):
+        import benchmark
+        for seed in range(5):
+            G = benchmark.random_dag(200, seed=seed)
+            for engine in ('networkx', 'array'):
+                sinks = confluent.confluent_flow(G, 't', engine=engine)
+                assert_equal(confluent.verify_confluent_flow(
+                    G, 't', sinks, require_all=True), [])
+        G = _digraph1()
+        sinks = confluent.confluent_flow(G, 't')
+        sinks[9]['tree_arcs'].append((0, 2))
+        sinks[8]['tree_arcs'].append((8, 4))
+        sinks[10]['tree_arcs'].remove((3, 10))
+        violations = confluent.verify_confluent_flow(G, 't', sinks,
+                                                     require_all=True)
+        assert_true(('two_next_hops', 0, 1, 2) in violations)
+        assert_true(('sink_has_next_hop', 8, 4) in violations)
+        assert_true(('not_an_arc', 8, 4) in violations)
+        assert_true(('no_path_to_sink', 3) in violations)
+        assert_true(('unserved', 3) in violations)
+        assert_true(('congestion', 10, 8, 3) in violations)
+        sinks = {'a': {'congestion': 0, 'color': 0,
+                       'tree_arcs': [('b', 'c'), ('c', 'b')]}}
+        violations = confluent.verify_confluent_flow(G, 't', sinks)
+        assert_true(('not_a_sink', 'a') in violations)
+        assert_true(('cycle', ['b', 'c']) in violations)
+
+        # Demands that cannot reach t are left out on purpose.
+        G = _digraph1()
+        G.add_node('x', demand=3)
+        sinks = confluent.confluent_flow(G, 't')
+        assert_equal(confluent.verify_confluent_flow(G, 't', sinks), [])
+        assert_equal(confluent.verify_confluent_flow(G, 't', sinks,
+                                                     require_all=True),
+                     [('unserved', 'x')])
+
+        # Nodes 4 and 5 are only partly served, which leaves the congestion
+        # of their tree below the sum of its demands.
+        import benchmark
+        G = benchmark.random_sparse(10, nb_sinks=1, seed=8154)
+        sinks, flow = confluent.confluent_flow(G, 't', return_flow=True)
+        assert_equal(sinks[0]['congestion'], 8)
+        assert_equal(confluent.verify_confluent_flow(G, 't', sinks), [])
+        assert_equal(confluent.verify_confluent_flow(G, 't', sinks,
+                                                     flow=flow), [])
+        violations = confluent.verify_confluent_flow(G, 't', sinks,
+                                                     require_all=True,
+                                                     flow=flow)
+        assert_equal(sorted(v for v in violations if v[0] != 'unserved'),
+                     [('partially_served', 4, 1, 2),
+                      ('partially_served', 5, 1, 2)])
+        violations = confluent.verify_confluent_flow(G, 't', sinks,
+                                                     require_all=True)
+        assert_true(('congestion', 0, 8, 10) in violations)
+        sinks[0]['congestion'] = 9
+        assert_equal(confluent.verify_confluent_flow(G, 't', sinks,
+                                                     flow=flow),
+                     [('congestion', 0, 9, 8)])
+
+    def test_greedy_method(self):
+        import benchmark
+        for seed in range(5):
+            G = benchmark.random_dag(200, seed=seed)
+            congestion = []
+            for max_moves in (0, 20):
+                stats = confluent.Stats()
+                sinks = confluent.confluent_flow(G, 't', method='greedy',
+                                                 max_moves=max_moves,
+                                                 observer=stats)
+                assert_equal(confluent.verify_confluent_flow(G, 't', sinks),
+                             [])
+                assert_equal(stats.congestion,
+                             max(d['congestion'] for d in sinks.values()))
+                assert_equal(stats.as_dict()['ratio'], None)
+                congestion.append(stats.congestion)
+            assert_true(congestion[1] <= congestion[0])
+            sinks, report = confluent.confluent_flow(G, 't', method='greedy',
+                                                     report=True)
+            lower_bound = confluent.congestion_lower_bound(G, 't')
+            assert_equal(report['lower_bound'], lower_bound)
+            assert_true(lower_bound <= report['congestion'])
+            # The bound is at least the trivial one.
+            demands = [d['demand'] for _, d in G.nodes_iter(data=True)
+                       if d.get('demand', 0) > 0]
+            assert_true(lower_bound >= max(demands))
+        trees = confluent.confluent_flow(_digraph1(), 't', method='greedy',
+                                         compact=True)
+        assert_equal(trees.path(0), [0, 1, 3, 10])
+        assert_raises(nx.NetworkXError, confluent.confluent_flow,
+                      _digraph1(), 't', method='fastest')
+        assert_raises(nx.NetworkXError, confluent.confluent_flow,
+                      _digraph1(), 't', max_moves=5)
+        for option in (dict(engine='array'), dict(processes=2),
+                       dict(time_budget=1), dict(max_iterations=10)):
+            assert_raises(nx.NetworkXError, confluent.confluent_flow,
+                          _digraph1(), 't', method='greedy', **option)
+
+    def test_congestion_lower_bound(self):
+        G = _digraph1()
+        sinks, report = confluent.confluent_flow(G, 't', report=True)
+        assert_equal(report['congestion'], 8)
+        assert_equal(report['lower_bound'], 6)
+        # The demands of 'a' and 'b' can only reach 't' through 'x', which
+        # is above both the largest demand and the average load of a sink.
+        G = nx.DiGraph()
+        G.add_edges_from([('a', 'x'), ('b', 'x'), ('c', 'z'), ('x', 't'),
+                          ('z', 't')])
+        G.node['a']['demand'] = 1
+        G.node['b']['demand'] = 2
+        G.node['c']['demand'] = 1
+        assert_equal(confluent.congestion_lower_bound(G, 't'), 3)
+        assert_equal(confluent.congestion_lower_bound(
+            G, 't', flow_func=confluent.csgraph_maximum_flow), 3)
+        G.node['a']['demand'] = 1.5
+        G.node['b']['demand'] = 1.5
+        G.node['c']['demand'] = 0.5
+        assert_almost_equal(confluent.congestion_lower_bound(G, 't'), 3,
+                            places=4)
+        # Two sinks reached by both demands share them.
+        G.add_edges_from([('a', 'z'), ('b', 'z')])
+        G['x']['t']['capacity'] = 2
+        G['z']['t']['capacity'] = 1.5
+        assert_almost_equal(confluent.congestion_lower_bound(G, 't'), 1.75,
+                            places=4)
+
+    def test_check_feasibility(self):
+        G = _digraph1()
+        sinks = confluent.confluent_flow(G, 't', check_feasibility=True)
+        assert_equal(sorted(sinks[v]['congestion'] for v in sinks),
+                     [3, 5, 8])
+        G.add_node('a', demand=1)
+        assert_raises(nx.NetworkXUnfeasible, confluent.confluent_flow, G,
+                      't', check_feasibility=True)
+        try:
+            confluent.confluent_flow(G, 't', check_feasibility=True)
+        except confluent.InfeasibleDemands as e:
+            assert_equal(e.unreachable, ['a'])
+            assert_equal(e.shortfall, 1)
+        G.remove_node('a')
+        G.node[0]['demand'] = 8
+        try:
+            confluent.confluent_flow(G, 't', check_feasibility=True)
+        except confluent.InfeasibleDemands as e:
+            assert_equal(sorted(e.cut), [(8, 't'), (9, 't'), (10, 't')])
+            assert_equal(e.shortfall, 4)
+        G.node[0]['demand'] = 5
+        G.node[5]['demand'] = 2
+        try:
+            confluent.confluent_flow(G, 't', check_feasibility=True)
+        except confluent.InfeasibleDemands as e:
+            assert_equal(sorted(e.cut), [(0, 1), (0, 2)])
+            assert_equal(e.shortfall, 1)
+        else:
+            assert_true(False)
+
+    def test_sinks_send_all_to_t(self):
+        # Without sinks upstream of others, the support is left unchanged.
+        G = _digraph1()
+        H = confluent._compute_support_for_max_flow(G, 't')
+        arcs = sorted(H.edges(data=True), key=str)
+        confluent._send_sinks_to_t(H, 't')
+        assert_equal(sorted(H.edges(data=True), key=str), arcs)
+
+        # The arc (v, t) is saturated, so v also sends flow through w.
+        G = nx.DiGraph()
+        G.add_edge('a', 'v', capacity=2)
+        G.add_edge('v', 't', capacity=1)
+        G.add_edge('v', 'w', capacity=5)
+        G.add_edge('w', 't', capacity=5)
+        G.node['a']['demand'] = 2
+        H = confluent._compute_support_for_max_flow(G, 't')
+        assert_equal(H['v']['w']['weight'], 1)
+        confluent._send_sinks_to_t(H, 't')
+        assert_false(H.has_edge('v', 'w'))
+        assert_equal(H['v']['t']['weight'], 2)
+        sinks = confluent.confluent_flow(G, 't')
+        assert_equal(sorted((v, sinks[v]['congestion']) for v in sinks),
+                     [('v', 2)])
+        assert_equal(confluent.verify_confluent_flow(G, 't', sinks), [])
+
+    def test_sinks_send_all_to_t_unchanged(self):
+        # When no sink feeds another sink, confluent_flow returns the same
+        # trees with or without the step.
+        import benchmark
+        instances = [_digraph1()]
+        for seed in range(20):
+            instances.append(benchmark.random_dag(12 + seed, nb_sinks=3,
+                                                  seed=seed))
+            instances.append(benchmark.random_sparse(12 + seed, nb_sinks=3,
+                                                     seed=seed))
+        send_sinks_to_t = confluent._send_sinks_to_t
+        nb_checked = 0
+        for G in instances:
+            H = confluent._compute_support_for_max_flow(G, 't')
+            if any(w != 't' for v in H.pred['t'] for w in H[v]):
+                continue
+            nb_checked += 1
+            sinks = confluent.confluent_flow(G.copy(), 't')
+            confluent._send_sinks_to_t = lambda H, t: H.add_node(t)
+            try:
+                unsent = confluent.confluent_flow(G.copy(), 't')
+            finally:
+                confluent._send_sinks_to_t = send_sinks_to_t
+            assert_equal(sinks, unsent)
+        assert_true(nb_checked > 10)
+
+    def test_confluent_flow_destinations(self):
+        G = _digraph1()
+        destinations = ['t', 10, 9, 6]
+        results = confluent.confluent_flow_destinations(G, destinations)
+        assert_equal(sorted(results, key=str), sorted(destinations, key=str))
+        for t in destinations:
+            assert_equal(results[t], confluent.confluent_flow(G, t))
+        assert_equal(confluent.confluent_flow_destinations(
+            G, destinations, processes=2), results)
+        assert_raises(nx.NetworkXError,
+                      confluent.confluent_flow_destinations, G, ['x'])
+
+    def test_confluent_unknown_engine(self):
+        assert_raises(nx.NetworkXError, confluent.confluent_flow,
+                      _digraph1(), 't', engine='fortran')
+
+
+class _Node(object):
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return '<Node>'
+
+
+def _digraph1():
+    G = nx.DiGraph()
+    G.add_weighted_edges_from([(0, 1, 3), (0, 2, 1), (1, 3, 3),
+                               (2, 6, 3), (3, 10, 3), (3, 7, 1),
+                               (4, 8, 1), (5, 4, 1), (5, 2, 1),
+                               (5, 9, 2), (6, 9, 3), (6, 10, 2),
+                               (7, 10, 2), (8, 't', 2), (9, 't', 5),
+                               (10, 't', 9)], weight='capacity')
+    demands = [4, 0, 1, 1, 0, 4, 2, 1, 1, 0, 2]
+    for v, d in enumerate(demands):
+        G.node[v]['demand'] = d
+    return G
+
+
+def _scanning_pivot(H, sinks, frontier_nodes, free_nodes, sink_for_color,
+                    observer=None, index=None):
+    # `_pivot` finding its pivot with the scan of the sinks it replaced.
+    for sink1 in sinks:
+        tree1_color = sinks[sink1]['color']
+        nb_in_neighbors = 0
+        arcs_to_tree1 = []
+        sink2 = None
+        for v in frontier_nodes:
+            initial_len = len(arcs_to_tree1)
+            sink = None
+            for neigh in H[v]:
+                neigh_color = H.node[neigh]['color']
+                if neigh_color == tree1_color:
+                    arcs_to_tree1.append((v, neigh))
+                elif neigh_color != -1:
+                    sink = sink_for_color[neigh_color]
+            if initial_len != len(arcs_to_tree1):
+                nb_in_neighbors += 1
+                if sink is not None:
+                    sink2 = sink
+                    tree2_color = sinks[sink2]['color']
+                    arcs_to_tree2 = [(v, u) for u in H[v]
+                                     if H.node[u]['color'] == tree2_color]
+        if nb_in_neighbors == 1 and sink2 is not None:
+            break
+    else:
+        return False
+    pivot_node = arcs_to_tree1[0][0]
+
+    flow = sum(H[u][v]['weight'] for u, v in arcs_to_tree2)
+    if sinks[sink1]['congestion'] + flow < sinks[sink2]['congestion'] - flow:
+        H[pivot_node][arcs_to_tree1[0][1]]['weight'] += flow
+        removed = arcs_to_tree2
+    else:
+        flow = sum(H[u][v]['weight'] for u, v in arcs_to_tree1)
+        H[pivot_node][arcs_to_tree2[0][1]]['weight'] += flow
+        removed = arcs_to_tree1
+        sink1, sink2 = sink2, sink1
+    for u, v in removed:
+        index.remove_arc(u, v)
+    sinks[sink1]['congestion'] += flow
+    sinks[sink2]['congestion'] -= flow
+    return True
+
+
+class TestFlowFunc:
+    @classmethod
+    def setup_class(cls):
+        try:
+            import scipy.sparse.csgraph
+        except ImportError:
+            raise SkipTest('SciPy not available.')
+        if not hasattr(scipy.sparse.csgraph, 'maximum_flow'):
+            raise SkipTest('SciPy >= 1.4 required.')
+
+    def test_csgraph_maximum_flow(self):
+        G = _digraph1()
+        G.add_edge('s', 0)
+        G.add_edge('s', 5)
+        flow_value, flow = confluent.csgraph_maximum_flow(G, 's', 't')
+        assert_equal(flow_value, nx.ford_fulkerson(G, 's', 't')[0])
+        for u, v, d in G.edges_iter(data=True):
+            assert_true(0 <= flow[u][v] <= d.get('capacity', flow_value))
+
+    def test_csgraph_fractional_capacity(self):
+        G = _digraph1()
+        G[0][1]['capacity'] = 2.5
+        assert_raises(nx.NetworkXError, confluent.csgraph_maximum_flow,
+                      G, 0, 't')
+
+    def test_confluent_flow_func(self):
+        sinks = confluent.confluent_flow(
+            _digraph1(), 't', flow_func=confluent.csgraph_maximum_flow)
+        assert_equal(sorted(sinks), [8, 9, 10])
+        assert_equal(sum(sinks[v]['congestion'] for v in sinks), 16)
+        tails = [u for v in sinks for u, _ in sinks[v]['tree_arcs']]
+        assert_equal(len(tails), len(set(tails)))
+
+    def test_confluent_flow_many_csgraph(self):
+        G = _digraph1()
+        demands = dict((v, G.node[v]['demand']) for v in G if v != 't')
+        for engine in ('networkx', 'array'):
+            results = list(confluent.confluent_flow_many(
+                G, 't', [demands, {5: 1}, {}, demands],
+                flow_func=confluent.csgraph_maximum_flow, engine=engine))
+            expected = confluent.confluent_flow(
+                G, 't', flow_func=confluent.csgraph_maximum_flow,
+                engine=engine)
+            for sinks in (results[0], results[3]):
+                assert_equal(sorted(sinks), sorted(expected))
+                for v in sinks:
+                    assert_equal(sinks[v]['congestion'],
+                                 expected[v]['congestion'])
+                    assert_equal(sorted(sinks[v]['tree_arcs']),
+                                 sorted(expected[v]['tree_arcs']))
+            assert_equal(sorted((v, d['congestion'])
+                                for v, d in results[1].items()), [(9, 1)])
+            assert_equal(results[2], {})
+        assert_raises(nx.NetworkXError, next, confluent.confluent_flow_many(
+            G, 't', [{0: 1.5}], flow_func=confluent.csgraph_maximum_flow))
+
+    def test_array_graph_cli(self):
+        import os
+        import shutil
+        import tempfile
+        import numpy as np
+        directory = tempfile.mkdtemp()
+        try:
+            G = _digraph1()
+            edgelist = os.path.join(directory, 'arcs.txt')
+            with open(edgelist, 'w') as f:
+                f.write('# tail head capacity\n')
+                for u, v, d in G.edges_iter(data=True):
+                    f.write('{} {} {}\n'.format(u, v, d['capacity']))
+            demands = os.path.join(directory, 'demands.txt')
+            with open(demands, 'w') as f:
+                for v, d in G.nodes_iter(data=True):
+                    if d.get('demand'):
+                        f.write('{} {}\n'.format(v, d['demand']))
+            graph_dir = os.path.join(directory, 'graph')
+            output = os.path.join(directory, 'trees.npz')
+            assert_equal(confluent.main(['convert', edgelist, graph_dir,
+                                         '--sink', 't',
+                                         '--demands', demands]), 0)
+            assert_equal(confluent.main(['solve', graph_dir, '-o', output]),
+                         0)
+
+            graph = confluent.ArrayGraph.load(graph_dir)
+            assert_true(isinstance(graph.heads, np.memmap))
+            assert_equal(graph.number_of_arcs(), G.number_of_edges())
+            labels = graph.node_labels()
+            result = np.load(output)
+            expected = confluent.confluent_flow(G, 't')
+            sinks = [int(labels[i]) for i in result['sinks']]
+            assert_equal(sorted(sinks), sorted(expected))
+            for i, c in zip(sinks, result['congestion']):
+                assert_equal(c, expected[i]['congestion'])
+            for v in expected:
+                for u, w in expected[v]['tree_arcs']:
+                    assert_equal(
+                        labels[result['parent'][labels.index(str(u))]],
+                        str(w))
+
+            # Networks with fractional capacities fall back to NetworkX.
+            G[0][1]['capacity'] = 3.5
+            graph = confluent.ArrayGraph.from_networkx(
+                nx.relabel_nodes(G, {'t': 11}), 11)
+            graph.save(graph_dir)
+            sinks = confluent.confluent_flow_arrays(graph_dir).to_dict()
+            expected = confluent.confluent_flow(G, 't', engine='array')
+            assert_equal(sorted(sinks), sorted(expected))
+            for v in expected:
+                assert_equal(sinks[v]['congestion'],
+                             expected[v]['congestion'])
+                assert_equal(sorted(sinks[v]['tree_arcs']),
+                             sorted(expected[v]['tree_arcs']))
+        finally:
+            shutil.rmtree(directory)
+
+
+def _slow_flow(G, s, t, capacity='capacity'):
+    import time
+    time.sleep(0.2)
+    return nx.ford_fulkerson(G, s, t, capacity=capacity)
+
+
+class TestService:
+    @classmethod
+    def setup_class(cls):
+        import sys
+        if sys.version_info < (3, 7):
+            raise SkipTest('Python >= 3.7 required.')
+
+    def setup(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def teardown(self):
+        import asyncio
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def gather(self, *coroutines):
+        import asyncio
+        return self.loop.run_until_complete(asyncio.gather(
+            *coroutines, return_exceptions=True))
+
+    def test_coalescing(self):
+        import confluent_service
+        service = confluent_service.SolveService(threads=2)
+        service.add_topology('g', _digraph1(), 't')
+        demands = {0: 4, 5: 4}
+        results = self.gather(*([service.solve('g') for _ in range(3)] +
+                                [service.solve('g', demands=demands)
+                                 for _ in range(2)]))
+        service.close()
+        assert_equal(results[0], confluent.confluent_flow(_digraph1(), 't'))
+        assert_true(results[1] is results[0])
+        assert_equal(results[3], next(confluent.confluent_flow_many(
+            _digraph1(), 't', [demands])))
+        assert_equal(service.stats(),
+                     {'requests': 5, 'solves': 2, 'coalesced': 3,
+                      'rejected': 0, 'timeouts': 0, 'pending': 0})
+        assert_true(isinstance(self.gather(service.solve('h'))[0],
+                               nx.NetworkXError))
+
+    def test_solver_reuse(self):
+        import confluent_service
+        service = confluent_service.SolveService(threads=2)
+        service.add_topology('g', _digraph1(), 't')
+        results = self.gather(service.solve('g', demands={0: 4, 5: 4}),
+                              service.solve('g', demands={0: 4.0, 5: 4,
+                                                          3: 0, 't': 1}))
+        assert_true(results[1] is results[0])
+        results = self.gather(service.solve('g', demands={0: 2}))
+        assert_equal(results[0], next(confluent.confluent_flow_many(
+            _digraph1(), 't', [{0: 2}])))
+        assert_equal((service.solves, service.coalesced), (2, 1))
+        # Both solves used the same solver.
+        assert_equal(list(service._solvers), [('g', 1, 't')])
+        assert_equal(len(service._solvers['g', 1, 't']), 1)
+        service.add_topology('g', _digraph1(), 't')
+        assert_equal(service._solvers, {})
+        results = self.gather(service.solve('g', t=10, demands={0: 1}),
+                              service.solve('g', t='x', demands={0: 1}))
+        assert_equal(sorted(results[0]), [3])
+        assert_true(isinstance(results[1], nx.NetworkXError))
+        service.close()
+
+    def test_backpressure_and_timeout(self):
+        import asyncio
+        import confluent_service
+        service = confluent_service.SolveService(threads=1, max_pending=2,
+                                                 flow_func=_slow_flow)
+        service.add_topology('g', _digraph1(), 't')
+        results = self.gather(service.solve('g', demands={0: 1}),
+                              service.solve('g', demands={0: 2}),
+                              service.solve('g', demands={0: 3}),
+                              service.solve('g', demands={0: 1}, timeout=0.05))
+        assert_equal(sorted(results[0]), [10])
+        assert_equal(sorted(results[1]), [10])
+        assert_true(isinstance(results[2], confluent_service.ServiceBusy))
+        assert_true(isinstance(results[3], asyncio.TimeoutError))
+        assert_equal((service.rejected, service.timeouts), (1, 1))
+        service.close()
+
+    def test_server(self):
+        import confluent_service
+        service = confluent_service.SolveService(processes=1)
+        service.add_topology('g', _digraph1(), 't')
+        server = self.loop.run_until_complete(
+            confluent_service.serve(service, port=0))
+        port = server.sockets[0].getsockname()[1]
+
+        responses = self.gather(confluent_service.query([
+            {'id': 1, 'topology': 'g'},
+            {'id': 2, 'topology': 'g', 't': 10, 'demands': [[0, 2]]},
+            {'id': 3, 'topology': 'h'}], port=port))[0]
+        responses.sort(key=lambda r: r['id'])
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+        service.close()
+        sinks = confluent.confluent_flow(_digraph1(), 't')
+        assert_equal(sorted(v for v, _, _ in responses[0]['sinks']),
+                     sorted(sinks))
+        for v, congestion, tree_arcs in responses[0]['sinks']:
+            assert_equal(congestion, sinks[v]['congestion'])
+            assert_equal(sorted(map(tuple, tree_arcs)),
+                         sorted(sinks[v]['tree_arcs']))
+        assert_equal(responses[1]['sinks'][0][:2], [3, 2])
+        assert_true('error' in responses[2])